@@ -1,19 +1,24 @@
 import os
+import re
 import json
 import asyncio
+import hmac
 import logging
+import logging.handlers
+import queue
 import sys
 import aiohttp
-import requests
-import uuid
-import pytz
+import httpx
+import orjson
 
 from pathlib import Path
 from datetime import datetime
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
-from telebot.types import Message
+from aiohttp import web
+from telebot.types import Message, Update
 from telebot.async_telebot import AsyncTeleBot
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, AsyncIterator
 
 
 # Load environment variables
@@ -27,6 +32,12 @@ OPWEBUI_API_KEY = os.getenv("OPWEBUI_API_KEY")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 N8N_WEBHOOK_URL = os.getenv("N8N_WEBHOOK_URL")
 
+# Optional Telegram webhook configuration (falls back to long polling when unset)
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+TELEGRAM_WEBHOOK_PORT = os.getenv("TELEGRAM_WEBHOOK_PORT") or "8080"
+_WEBHOOK_SECRET_RE = re.compile(r'[A-Za-z0-9_-]{1,256}')  # Charset Telegram accepts for secret_token
+
 def validate_config():
     """Validate required environment variables"""
     required_vars = {
@@ -42,6 +53,16 @@ def validate_config():
         logger.error(f"❌ Missing required environment variables: {', '.join(missing_vars)}")
         return False
     
+    if TELEGRAM_WEBHOOK_URL:
+        # The webhook is public, so every update must carry the shared secret
+        if not TELEGRAM_WEBHOOK_SECRET or not _WEBHOOK_SECRET_RE.fullmatch(TELEGRAM_WEBHOOK_SECRET):
+            logger.error("❌ TELEGRAM_WEBHOOK_SECRET is required in webhook mode (1-256 characters: A-Z, a-z, 0-9, _ and -)")
+            return False
+        
+        if not TELEGRAM_WEBHOOK_PORT.isdigit() or not 0 < int(TELEGRAM_WEBHOOK_PORT) < 65536:
+            logger.error(f"❌ Invalid TELEGRAM_WEBHOOK_PORT: {TELEGRAM_WEBHOOK_PORT}")
+            return False
+    
     logger.info("✅ All required environment variables are set")
     return True
 
@@ -56,29 +77,61 @@ DOCKER_HOSTS = [
     "n8n"           # If container named 'n8n'
 ]
 MAX_RETRIES = 3
+WEBHOOK_PATH = "/webhook"
+_TZ = ZoneInfo("Asia/Kuala_Lumpur")
+_PROTOCOL_VERSION = datetime.now(_TZ).strftime("%Y-%m-%d")
+SSE_COMPACT_SIZE = 64 * 1024  # Drop consumed SSE bytes once the cursor passes this
 
 def build_url(host: str, port: int = DEFAULT_PORT, path: str = "") -> str:
     """Build URL with proper formatting"""
     return f"http://{host}:{port}{path}"
 
+_MCP_PREFIX_RE = re.compile(r'/(mcp|webhook-test|mcp-test)/(.+)$')
+
 def extract_mcp_path(webhook_url: str) -> tuple[str, str]:
     """Extract MCP path from webhook URL and return (mcp_url, direct_webhook)"""
-    # Handle different URL patterns
-    if "/mcp/" in webhook_url:
-        mcp_path = webhook_url.split("/mcp/")[1]
-        mcp_endpoint = f"/mcp/{mcp_path}"
-    elif "/webhook-test/" in webhook_url:
-        mcp_path = webhook_url.split("/webhook-test/")[1]
-        mcp_endpoint = f"/webhook-test/{mcp_path}"
-    elif "/mcp-test/" in webhook_url:
-        mcp_path = webhook_url.split("/mcp-test/")[1]
-        mcp_endpoint = f"/mcp-test/{mcp_path}"
+    # Handle /mcp/, /webhook-test/ and /mcp-test/ URL patterns
+    match = _MCP_PREFIX_RE.search(webhook_url)
+    if match:
+        mcp_endpoint = f"/{match.group(1)}/{match.group(2)}"
     else:
         # Fallback
         mcp_endpoint = "/api/mcp"
     
     return mcp_endpoint, mcp_endpoint
 
+def _sse_data_start(buf: bytearray, pos: int) -> int:
+    """Return where the payload of a 'data:' line at pos starts, or -1"""
+    if not buf.startswith(b'data:', pos):
+        return -1
+    # The field name may be followed by a single optional space
+    return pos + 6 if buf.startswith(b' ', pos + 5) else pos + 5
+
+async def iter_sse_data(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Yield the payload of each SSE 'data:' line as the response body streams in"""
+    buf = bytearray()
+    pos = 0
+    async for chunk in chunks:
+        # Only scan the new bytes for newlines, so long lines split across
+        # many chunks stay linear
+        scan = len(buf)
+        buf += chunk
+        while (nl := buf.find(b'\n', max(pos, scan))) != -1:
+            start = _sse_data_start(buf, pos)
+            if start != -1:
+                end = nl - 1 if nl > start and buf[nl - 1] == 0x0D else nl  # Tolerate CRLF line endings
+                yield bytes(buf[start:end])
+            pos = nl + 1
+        # Bound memory by discarding lines that were already consumed
+        if pos >= SSE_COMPACT_SIZE:
+            del buf[:pos]
+            pos = 0
+    
+    # Last line may not be newline-terminated
+    start = _sse_data_start(buf, pos)
+    if start != -1:
+        yield bytes(buf[start:]).rstrip(b'\r')
+
 # Extract MCP configuration
 MCP_ENDPOINT_PATH, DIRECT_WEBHOOK_PATH = extract_mcp_path(N8N_WEBHOOK_URL)
 
@@ -90,15 +143,25 @@ log_dir = root_dir / "logs"
 log_dir.mkdir(exist_ok=True)
 log_file = log_dir / "telegram_mcp_client.log"
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
+# Records are queued on the event loop thread and written by a listener thread,
+# so file and console I/O never block the loop
+log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+log_handlers = [
+    logging.FileHandler(log_file),
+    logging.StreamHandler()
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+root_logger = logging.getLogger()
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+root_logger.setLevel(logging.INFO)
+
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
 logger = logging.getLogger("telegram_mcp_client")
+logging.getLogger("httpx").setLevel(logging.WARNING)  # Skip per-request INFO lines
 
 class N8nMCPClient:
     """MCP Client implementing Streamable HTTP transport for n8n"""
@@ -107,51 +170,100 @@ class N8nMCPClient:
         self.endpoint_path = endpoint_path
         self.base_url = None  # Will be set after connectivity test
         self.available_tools: List[Dict] = []
+        self.tools_by_name: Dict[str, Dict] = {}
+        self.tool_names: List[str] = []
+        self._cached_system_prompt: Optional[str] = None
         self.initialized = False
         self.server_capabilities = {}
         self._session_lock = asyncio.Lock()
+        self._renew_lock = asyncio.Lock()
+        self._renew_task: Optional[asyncio.Task] = None
+        self._session: Optional[aiohttp.ClientSession] = None
         self.session_id = None
-        tz = pytz.timezone("Asia/Kuala_Lumpur")
-        self.protocol_version = datetime.now(tz).strftime("%Y-%m-%d")
+        self._rpc_id = 0
+        self.protocol_version = _PROTOCOL_VERSION
+        self._base_headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json, text/event-stream",
+            "MCP-Protocol-Version": self.protocol_version,
+            "User-Agent": "n8n-mcp-telegram-client/1.0"
+        }
     
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Get the shared HTTP session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                keepalive_timeout=60,
+                enable_cleanup_closed=True
+            )
+            timeout = aiohttp.ClientTimeout(total=30)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def aclose(self):
+        """Close the shared HTTP session"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _next_id(self, prefix: str) -> str:
+        """Get the next JSON-RPC request ID (unique within this client)"""
+        self._rpc_id += 1
+        return f"{prefix}-{self._rpc_id}"
+
+    def _set_tools(self, tools: List[Dict]):
+        """Store the tool list along with its name index and system prompt"""
+        self.available_tools = tools
+        self.tools_by_name = {tool["name"]: tool for tool in tools if tool.get("name")}
+        self.tool_names = list(self.tools_by_name)
+        self._cached_system_prompt = _build_workflow_prompt(tools)
+
     def get_available_tools(self) -> List[str]:
         """Get list of available tool names"""
-        return [tool.get("name", "") for tool in self.available_tools if tool.get("name")]
+        return self.tool_names
     
-    async def test_n8n_connectivity(self) -> tuple[bool, str]:
-        """Test n8n connectivity across different host configurations"""
-        for host in DOCKER_HOSTS:
-            test_url = build_url(host, DEFAULT_PORT)
-            try:
-                logger.debug(f"🔍 Testing connectivity at: {test_url}")
-                
-                connector = aiohttp.TCPConnector(limit=10, limit_per_host=5)
-                timeout = aiohttp.ClientTimeout(total=5)
-                
-                async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-                    async with session.get(test_url) as response:
-                        if response.status == 200:
-                            logger.info(f"✅ n8n accessible at: {test_url}")
-                            return True, test_url
-                            
-            except Exception as e:
-                logger.debug(f"❌ Failed to connect to {test_url}: {e}")
-                continue
+    async def _probe(self, host: str) -> tuple[bool, str]:
+        """Probe a single host for a running n8n instance"""
+        test_url = build_url(host, DEFAULT_PORT)
+        logger.debug(f"🔍 Testing connectivity at: {test_url}")
         
-        return False, "No n8n instance accessible"
+        session = await self._get_session()
+        timeout = aiohttp.ClientTimeout(total=2)
+        
+        async with session.get(test_url, timeout=timeout) as response:
+            if response.status != 200:
+                raise aiohttp.ClientResponseError(
+                    response.request_info,
+                    response.history,
+                    status=response.status,
+                    message=f"Unexpected status from {test_url}"
+                )
+        return True, test_url
 
-    def parse_sse_response(self, response_text: str) -> Optional[Dict]:
-        """Parse Server-Sent Events response according to MCP spec"""
+    async def test_n8n_connectivity(self) -> tuple[bool, str]:
+        """Test n8n connectivity across different host configurations in parallel"""
+        pending = {asyncio.create_task(self._probe(host)): host for host in DOCKER_HOSTS}
+        
         try:
-            lines = response_text.strip().split('\n')
-            for line in lines:
-                if line.startswith('data: '):
-                    data_part = line[6:]  # Remove 'data: ' prefix
-                    if data_part and data_part != '[DONE]':
-                        return json.loads(data_part)
-        except Exception as e:
-            logger.debug(f"Error parsing SSE: {e}")
-        return None
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    host = pending.pop(task)
+                    try:
+                        found, test_url = task.result()
+                    except Exception as e:
+                        logger.debug(f"❌ Failed to connect to {build_url(host, DEFAULT_PORT)}: {e}")
+                        continue
+                    
+                    logger.info(f"✅ n8n accessible at: {test_url}")
+                    return found, test_url
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        return False, "No n8n instance accessible"
 
     async def send_mcp_request(self, request: Dict[str, Any]) -> Optional[Dict]:
         """Send MCP request using Streamable HTTP transport"""
@@ -159,75 +271,92 @@ class N8nMCPClient:
             logger.error("❌ Base URL not set - run connectivity test first")
             return None
             
-        # Add retry logic
-        for attempt in range(MAX_RETRIES):
+        # Serialize once; encoding errors (e.g. integers beyond 64 bits) are permanent
+        try:
+            body = orjson.dumps(request)
+        except TypeError as e:
+            logger.error(f"❌ Could not encode MCP request: {e}")
+            return None
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📤 Request: %s", orjson.dumps(request, option=orjson.OPT_INDENT_2).decode())
+        
+        renewed = False
+        
+        # Add retry logic (attempt is 0-based; a session renewal hands it back)
+        attempt = -1
+        while (attempt := attempt + 1) < MAX_RETRIES:
             try:
                 mcp_url = f"{self.base_url}{self.endpoint_path}"
+                session = await self._get_session()
                 
-                connector = aiohttp.TCPConnector(limit=10, limit_per_host=5)
-                timeout = aiohttp.ClientTimeout(total=30)
+                # Add session ID if available (initialize always starts a new session)
+                sent_session_id = self.session_id if request.get("method") != "initialize" else None
+                if sent_session_id:
+                    headers = {**self._base_headers, "Mcp-Session-Id": sent_session_id}
+                else:
+                    headers = self._base_headers
                 
-                async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-                    headers = {
-                        "Content-Type": "application/json",
-                        "Accept": "application/json, text/event-stream",
-                        "MCP-Protocol-Version": self.protocol_version,
-                        "User-Agent": "n8n-mcp-telegram-client/1.0"
-                    }
+                logger.debug("📡 Sending MCP request to: %s", mcp_url)
+                
+                async with session.post(mcp_url, data=body, headers=headers) as response:
+                    # Handle session ID from server
+                    if "Mcp-Session-Id" in response.headers:
+                        self.session_id = response.headers["Mcp-Session-Id"]
+                        logger.debug("🔑 Session ID: %s...", self.session_id[:8])
                     
-                    # Add session ID if available
-                    if self.session_id:
-                        headers["Mcp-Session-Id"] = self.session_id
+                    if response.status == 200 and "text/event-stream" in response.headers.get("Content-Type", ""):
+                        # Stream SSE and parse only the final data line
+                        last_data = None
+                        async for data in iter_sse_data(response.content.iter_any()):
+                            if data and data != b'[DONE]':
+                                last_data = data
+                        
+                        if last_data:
+                            try:
+                                sse_data = orjson.loads(last_data)
+                                logger.info("✅ MCP SSE response received")
+                                return sse_data
+                            except orjson.JSONDecodeError as e:
+                                logger.debug("Error parsing SSE: %s", e)
+                        continue
                     
-                    logger.debug(f"📡 Sending MCP request to: {mcp_url}")
-                    logger.debug(f"📤 Request: {json.dumps(request, indent=2)}")
+                    response_text = await response.text()
                     
-                    async with session.post(mcp_url, json=request, headers=headers) as response:
-                        response_text = await response.text()
-                        
-                        # Handle session ID from server
-                        if "Mcp-Session-Id" in response.headers:
-                            self.session_id = response.headers["Mcp-Session-Id"]
-                            logger.debug(f"🔑 Session ID: {self.session_id[:8]}...")
-                        
-                        if response.status == 200:
-                            # Parse SSE or JSON response
-                            if "text/event-stream" in response.headers.get("Content-Type", ""):
-                                sse_data = self.parse_sse_response(response_text)
-                                if sse_data:
-                                    logger.info("✅ MCP SSE response received")
-                                    return sse_data
-                            else:
-                                try:
-                                    result = json.loads(response_text)
-                                    logger.info("✅ MCP JSON response received")
-                                    return result
-                                except json.JSONDecodeError:
-                                    logger.warning("Failed to parse JSON response")
-                        
-                        elif response.status == 202:
-                            logger.info("✅ MCP notification accepted")
-                            return {"status": "accepted"}
-                        
-                        elif response.status == 400:
-                            logger.error(f"❌ MCP Bad Request: {response_text[:200]}...")
-                            return None
-                        
-                        elif response.status == 404:
-                            logger.error("❌ MCP Session expired, reinitializing...")
-                            self.session_id = None
-                            self.initialized = False
-                            # Don't retry on session expiration
-                            return None
+                    if response.status == 200:
+                        try:
+                            result = orjson.loads(response_text)
+                            logger.info("✅ MCP JSON response received")
+                            return result
+                        except orjson.JSONDecodeError:
+                            logger.warning("Failed to parse JSON response")
+                    
+                    elif response.status == 202:
+                        logger.info("✅ MCP notification accepted")
+                        return {"status": "accepted"}
+                    
+                    elif response.status == 400:
+                        logger.error(f"❌ MCP Bad Request: {response_text[:200]}...")
+                        return None
+                    
+                    elif response.status == 404:
+                        logger.error("❌ MCP Session expired, reinitializing...")
+                        # Renew the session in place and retry once; a 404 without
+                        # a session (e.g. on the initialize request itself) is final
+                        if sent_session_id and not renewed and await self._reinitialize_session(sent_session_id):
+                            renewed = True
+                            attempt -= 1  # The renewal retry does not use up an attempt
+                            continue
+                        return None
+                    
+                    else:
+                        logger.error(f"❌ MCP error {response.status}: {response_text[:200]}...")
+                        # Only retry on server errors (5xx)
+                        if response.status >= 500 and attempt < MAX_RETRIES - 1:
+                            await asyncio.sleep(2 ** attempt)  # Exponential backoff
+                            continue
+                        return None
                         
-                        else:
-                            logger.error(f"❌ MCP error {response.status}: {response_text[:200]}...")
-                            # Only retry on server errors (5xx)
-                            if response.status >= 500 and attempt < MAX_RETRIES - 1:
-                                await asyncio.sleep(2 ** attempt)  # Exponential backoff
-                                continue
-                            return None
-                            
             except asyncio.TimeoutError:
                 logger.warning(f"⏰ Request timeout (attempt {attempt + 1}/{MAX_RETRIES})")
                 if attempt < MAX_RETRIES - 1:
@@ -241,6 +370,46 @@ class N8nMCPClient:
                     await asyncio.sleep(2 ** attempt)
                     continue
                 return None
+        
+        logger.error(f"❌ No usable MCP response after {MAX_RETRIES} attempts")
+        return None
+
+    async def _handshake(self) -> bool:
+        """Send the MCP initialize request and initialized notification"""
+        init_request = {
+            "jsonrpc": "2.0",
+            "id": self._next_id("init"),
+            "method": "initialize",
+            "params": {
+                "protocolVersion": self.protocol_version,
+                "capabilities": {"tools": {}},
+                "clientInfo": {
+                    "name": "n8n-mcp-telegram-client",
+                    "version": "1.0.0"
+                }
+            }
+        }
+        
+        logger.info("🔄 Initializing MCP connection...")
+        init_response = await self.send_mcp_request(init_request)
+        
+        if not init_response or "result" not in init_response:
+            logger.error("❌ MCP initialization failed")
+            return False
+        
+        # Parse server info
+        result = init_response["result"]
+        self.server_capabilities = result.get("capabilities", {})
+        server_info = result.get("serverInfo", {})
+        
+        logger.info(f"✅ Connected to {server_info.get('name', 'Unknown')} v{server_info.get('version', '?')}")
+        
+        # Send initialized notification
+        await self.send_mcp_request({
+            "jsonrpc": "2.0",
+            "method": "notifications/initialized"
+        })
+        return True
 
     async def initialize(self) -> bool:
         """Initialize MCP client"""
@@ -255,42 +424,9 @@ class N8nMCPClient:
                 self.base_url = n8n_url
                 logger.info(f"✅ Using n8n at: {n8n_url}")
                 
-                # Send MCP initialize request
-                init_request = {
-                    "jsonrpc": "2.0",
-                    "id": f"init-{uuid.uuid4()}",
-                    "method": "initialize",
-                    "params": {
-                        "protocolVersion": self.protocol_version,
-                        "capabilities": {"tools": {}},
-                        "clientInfo": {
-                            "name": "n8n-mcp-telegram-client",
-                            "version": "1.0.0"
-                        }
-                    }
-                }
-                
-                logger.info("🔄 Initializing MCP connection...")
-                init_response = await self.send_mcp_request(init_request)
-                
-                if not init_response or "result" not in init_response:
-                    logger.error("❌ MCP initialization failed")
+                if not await self._handshake():
                     return False
                 
-                # Parse server info
-                result = init_response["result"]
-                self.server_capabilities = result.get("capabilities", {})
-                server_info = result.get("serverInfo", {})
-                
-                logger.info(f"✅ Connected to {server_info.get('name', 'Unknown')} v{server_info.get('version', '?')}")
-                
-                # Send initialized notification
-                await asyncio.sleep(0.1)
-                await self.send_mcp_request({
-                    "jsonrpc": "2.0",
-                    "method": "notifications/initialized"
-                })
-                
                 # Fetch available tools
                 await self.fetch_available_tools()
                 
@@ -301,12 +437,39 @@ class N8nMCPClient:
                 logger.error(f"❌ MCP initialization error: {e}")
                 return False
 
+    async def _reinitialize_session(self, expired_session_id: str) -> bool:
+        """Renew an expired MCP session, keeping the known base URL and tools"""
+        # A 404 during the renewal handshake itself must not renew again
+        if self._renew_task is asyncio.current_task():
+            return False
+        
+        # Separate from _session_lock, which initialize() may hold while this runs
+        async with self._renew_lock:
+            # Another request already renewed the session while this one waited
+            if self.session_id != expired_session_id:
+                return self.session_id is not None
+            
+            self._renew_task = asyncio.current_task()
+            try:
+                if await self._handshake():
+                    logger.info("✅ MCP session renewed")
+                    return True
+            except Exception as e:
+                logger.error(f"❌ MCP session renewal error: {e}")
+            finally:
+                self._renew_task = None
+            
+            # Fall back to a full initialize() on the next call
+            self.session_id = None
+            self.initialized = False
+            return False
+
     async def fetch_available_tools(self) -> bool:
         """Fetch available tools from MCP server"""
         try:
             tools_request = {
                 "jsonrpc": "2.0",
-                "id": f"tools-{uuid.uuid4()}",
+                "id": self._next_id("tools"),
                 "method": "tools/list",
                 "params": {}
             }
@@ -317,7 +480,7 @@ class N8nMCPClient:
             if tools_response and "result" in tools_response:
                 tools = tools_response["result"].get("tools", [])
                 if tools:
-                    self.available_tools = tools
+                    self._set_tools(tools)
                     logger.info(f"✅ Found {len(tools)} tools")
                     
                     # Log tool details
@@ -336,14 +499,14 @@ class N8nMCPClient:
             
             # Fallback to predefined tools
             logger.warning("⚠️ Using predefined tools as fallback")
-            self.available_tools = [
+            self._set_tools([
                 {"name": "Find_Emails", "description": "Find and retrieve emails from Gmail"},
                 {"name": "Send_Email", "description": "Send an email via Gmail"},
                 {"name": "Create_an_event", "description": "Create a calendar event in Google Calendar"},
                 {"name": "Find_single_event", "description": "Find a specific calendar event"},
                 {"name": "Find_multiple_events", "description": "Find multiple calendar events"},  
                 {"name": "Update_event", "description": "Update an existing calendar event"}
-            ]
+            ])
             logger.info(f"✅ Using {len(self.available_tools)} predefined tools")
             return True
                 
@@ -356,13 +519,19 @@ class N8nMCPClient:
         if not self.initialized and not await self.initialize():
             return "❌ MCP client not initialized"
         
+        # Reject unknown (e.g. hallucinated) tool names without a round trip
+        if self.tools_by_name and tool_name not in self.tools_by_name:
+            logger.warning(f"⚠️ Unknown tool requested: {tool_name}")
+            return f"❌ Unknown tool: {tool_name}"
+        
         logger.info(f"🔧 Calling tool: {tool_name}")
-        logger.debug(f"📤 Arguments: {json.dumps(arguments, indent=2)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📤 Arguments: %s", json.dumps(arguments, indent=2))
         
         try:
             tool_request = {
                 "jsonrpc": "2.0",
-                "id": f"tool-{uuid.uuid4()}",
+                "id": self._next_id("tool"),
                 "method": "tools/call",
                 "params": {
                     "name": tool_name,
@@ -395,49 +564,50 @@ class N8nMCPClient:
 # Initialize MCP client
 mcp_client = N8nMCPClient(MCP_ENDPOINT_PATH)
 
+# Shared HTTP/2 client for OpenWebUI requests (created in main)
+llm_client: Optional[httpx.AsyncClient] = None
+
+WORKFLOW_KEYWORDS = [
+    'workflow', 'automation', 'process', 'trigger', 'n8n', 'run', 
+    'email', 'calendar', 'gmail', 'send', 'find', 'create', 'search'
+]
+_WORKFLOW_RE = re.compile("|".join(re.escape(keyword) for keyword in WORKFLOW_KEYWORDS), re.IGNORECASE)
+
 def classify_query(query: str) -> str:
     """Classify user query type"""
-    query_lower = query.lower()
-    workflow_keywords = [
-        'workflow', 'automation', 'process', 'trigger', 'n8n', 'run', 
-        'email', 'calendar', 'gmail', 'send', 'find', 'create', 'search'
-    ]
-    
-    if any(keyword in query_lower for keyword in workflow_keywords):
-        return "n8n_workflows"
-    
-    return "general"
+    return "n8n_workflows" if _WORKFLOW_RE.search(query) else "general"
 
-async def process_with_llm(query: str, endpoint_type: str = None) -> str:
-    """Process query with LLM"""
-    if endpoint_type == "n8n_workflows":
-        # Build tool information for prompt
-        tools_info = []
-        for tool in mcp_client.available_tools:
-            name = tool.get("name", "Unknown")
-            description = tool.get("description", "No description")
-            schema = tool.get("inputSchema", {})
-            
-            # Extract parameter information
-            properties = schema.get("properties", {})
-            required = schema.get("required", [])
-            
-            param_info = []
-            for param_name, param_details in properties.items():
-                param_type = param_details.get("type", "string")
-                param_desc = param_details.get("description", "")
-                is_required = " (required)" if param_name in required else " (optional)"
-                param_line = f'"{param_name}": {param_type}{is_required}'
-                if param_desc:
-                    param_line += f' - {param_desc}'
-                param_info.append(param_line)
-            
-            params_str = ", ".join(param_info) if param_info else "No parameters"
-            tools_info.append(f"• **{name}**: {description}\n  Parameters: {{{params_str}}}")
+GENERAL_SYSTEM_PROMPT = "You are a helpful assistant. Answer questions conversationally."
+
+def _build_workflow_prompt(tools: List[Dict]) -> str:
+    """Build the tool-calling system prompt for the given MCP tools"""
+    # Build tool information for prompt
+    tools_info = []
+    for tool in tools:
+        name = tool.get("name", "Unknown")
+        description = tool.get("description", "No description")
+        schema = tool.get("inputSchema", {})
         
-        tools_list = "\n".join(tools_info) if tools_info else "No tools available"
+        # Extract parameter information
+        properties = schema.get("properties", {})
+        required = schema.get("required", [])
         
-        system_prompt = f"""You are an assistant that can call tools through an MCP server.
+        param_info = []
+        for param_name, param_details in properties.items():
+            param_type = param_details.get("type", "string")
+            param_desc = param_details.get("description", "")
+            is_required = " (required)" if param_name in required else " (optional)"
+            param_line = f'"{param_name}": {param_type}{is_required}'
+            if param_desc:
+                param_line += f' - {param_desc}'
+            param_info.append(param_line)
+        
+        params_str = ", ".join(param_info) if param_info else "No parameters"
+        tools_info.append(f"• **{name}**: {description}\n  Parameters: {{{params_str}}}")
+    
+    tools_list = "\n".join(tools_info) if tools_info else "No tools available"
+    
+    return f"""You are an assistant that can call tools through an MCP server.
 
                         Available tools:
                         {tools_list}
@@ -456,8 +626,13 @@ async def process_with_llm(query: str, endpoint_type: str = None) -> str:
                         - Send email: Send_Email with {{"To": "email", "Subject": "text", "Message": "text"}}
                         - Calendar events: Find_multiple_events with {{}}
                         - Create event: Create_an_event with {{"Start": "ISO_date", "End": "ISO_date", "Description": "text"}}"""
+
+async def process_with_llm(query: str, endpoint_type: str = None) -> str:
+    """Process query with LLM"""
+    if endpoint_type == "n8n_workflows":
+        system_prompt = mcp_client._cached_system_prompt or _build_workflow_prompt([])
     else:
-        system_prompt = "You are a helpful assistant. Answer questions conversationally."
+        system_prompt = GENERAL_SYSTEM_PROMPT
     
     try:
         headers = {
@@ -465,27 +640,51 @@ async def process_with_llm(query: str, endpoint_type: str = None) -> str:
             "Content-Type": "application/json"
         }
         
-        response = requests.post(
-            OPWEBUI_URL,
-            headers=headers,
-            json={
-                "model": OPWEBUI_MODEL,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query}
-                ]
-            }
-        )
+        payload = {
+            "model": OPWEBUI_MODEL,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": query}
+            ],
+            "stream": True
+        }
         
-        response.raise_for_status()
-        response_json = response.json()
+        async with llm_client.stream("POST", OPWEBUI_URL, headers=headers, json=payload) as response:
+            response.raise_for_status()
+            
+            if "text/event-stream" not in response.headers.get("Content-Type", ""):
+                # Server ignored streaming, fall back to a single JSON body
+                response_json = orjson.loads(await response.aread())
+                
+                if 'choices' in response_json and len(response_json['choices']) > 0:
+                    choice = response_json['choices'][0]
+                    if 'message' in choice and 'content' in choice['message']:
+                        return choice['message']['content'].strip()
+                    elif 'text' in choice:
+                        return choice['text'].strip()
+                
+                return "Sorry, I couldn't process your request."
+            
+            # Accumulate content deltas and join once at the end
+            parts = []
+            async for data in iter_sse_data(response.aiter_bytes()):
+                if not data or data == b'[DONE]':
+                    continue
+                
+                frame = orjson.loads(data)
+                if frame.get("error"):
+                    logger.error(f"LLM stream error: {frame['error']}")
+                    continue
+                
+                choices = frame.get("choices")
+                if choices:
+                    choice = choices[0]
+                    content = (choice.get("delta") or {}).get("content") or choice.get("text")
+                    if content:
+                        parts.append(content)
         
-        if 'choices' in response_json and len(response_json['choices']) > 0:
-            choice = response_json['choices'][0]
-            if 'message' in choice and 'content' in choice['message']:
-                return choice['message']['content'].strip()
-            elif 'text' in choice:
-                return choice['text'].strip()
+        if parts:
+            return "".join(parts).strip()
         
         return "Sorry, I couldn't process your request."
         
@@ -493,6 +692,8 @@ async def process_with_llm(query: str, endpoint_type: str = None) -> str:
         logger.error(f"LLM processing error: {e}")
         return "❌ Error connecting to AI service."
 
+_JSON_DECODER = json.JSONDecoder()
+
 def extract_tool_call(text: str) -> tuple[Optional[str], Dict[str, Any]]:
     """Extract tool call information from LLM response"""
     if "ACTION:" not in text or "call_tool" not in text:
@@ -510,27 +711,13 @@ def extract_tool_call(text: str) -> tuple[Optional[str], Dict[str, Any]]:
         if "ARGUMENTS:" in text:
             args_text = text.split("ARGUMENTS:", 1)[1].strip()
             
-            # Find JSON object
+            # Decode the first JSON object, ignoring any trailing text
             start_idx = args_text.find("{")
             if start_idx != -1:
-                brace_count = 0
-                end_idx = -1
-                
-                for i in range(start_idx, len(args_text)):
-                    if args_text[i] == '{':
-                        brace_count += 1
-                    elif args_text[i] == '}':
-                        brace_count -= 1
-                        if brace_count == 0:
-                            end_idx = i
-                            break
-                
-                if end_idx != -1:
-                    args_json = args_text[start_idx:end_idx+1]
-                    try:
-                        arguments = json.loads(args_json)
-                    except json.JSONDecodeError:
-                        logger.warning(f"Failed to parse arguments for {tool_name}")
+                try:
+                    arguments, _ = _JSON_DECODER.raw_decode(args_text, start_idx)
+                except json.JSONDecodeError:
+                    logger.warning(f"Failed to parse arguments for {tool_name}")
         
         return tool_name, arguments
         
@@ -538,6 +725,9 @@ def extract_tool_call(text: str) -> tuple[Optional[str], Dict[str, Any]]:
         logger.warning(f"Error extracting tool call: {e}")
         return None, {}
 
+# Markdown characters escaped in tool names and descriptions
+_MD_ESCAPE = str.maketrans({'_': '\\_', '*': '\\*', '[': '\\[', ']': '\\]', '(': '\\(', ')': '\\)'})
+
 # Bot command handlers
 @bot.message_handler(commands=['start', 'help'])
 async def help_command(message: Message):
@@ -586,8 +776,13 @@ async def status_command(message: Message):
 @bot.message_handler(commands=['tools'])
 async def tools_command(message: Message):
     """List available tools"""
+    # General chat no longer initializes MCP, so discover tools on demand
+    if not mcp_client.initialized and not await mcp_client.initialize():
+        await bot.reply_to(message, "❌ Could not connect to n8n server")
+        return
+    
     if not mcp_client.available_tools:
-        await bot.reply_to(message, "🔍 No tools discovered yet. Try sending a message first.")
+        await bot.reply_to(message, "🔍 No tools discovered on the n8n MCP server.")
         return
     
     tools_text = "🛠️ **Available Tools:**\n\n"
@@ -595,8 +790,8 @@ async def tools_command(message: Message):
         name = tool.get("name", "Unknown")
         description = tool.get("description", "No description")
         # Escape markdown characters in name and description
-        escaped_name = name.replace('_', '\\_').replace('*', '\\*').replace('[', '\\[').replace(']', '\\]').replace('(', '\\(').replace(')', '\\)')
-        escaped_description = description.replace('_', '\\_').replace('*', '\\*').replace('[', '\\[').replace(']', '\\]').replace('(', '\\(').replace(')', '\\)')
+        escaped_name = name.translate(_MD_ESCAPE)
+        escaped_description = description.translate(_MD_ESCAPE)
         tools_text += f"• **{escaped_name}**: {escaped_description}\n"
     
     await bot.reply_to(message, tools_text, parse_mode="Markdown")
@@ -611,16 +806,17 @@ async def handle_message(message):
     logger.info(f"📨 User {user_id}: {query}")
 
     try:
+        # Classify first so general queries skip n8n entirely
+        query_type = classify_query(query)
+        logger.info(f"🔍 Query type: {query_type}")
+        
         # Initialize MCP client if needed
-        if not mcp_client.initialized:
+        if query_type == "n8n_workflows" and not mcp_client.initialized:
             if not await mcp_client.initialize():
                 await bot.reply_to(message, "❌ Could not connect to n8n server")
                 return
         
         # Process query
-        query_type = classify_query(query)
-        logger.info(f"🔍 Query type: {query_type}")
-        
         llm_response = await process_with_llm(query, query_type)
         logger.info(f"🤖 LLM response received")
         
@@ -641,7 +837,7 @@ async def handle_message(message):
             else:
                 # Success - try to format as JSON
                 try:
-                    json_result = json.loads(result)
+                    json_result = orjson.loads(result)
                     formatted_result = json.dumps(json_result, indent=2, ensure_ascii=False)
                     
                     response_message = f"✅ **Tool: {tool_name}**\n\n```json\n{formatted_result}\n```"
@@ -664,10 +860,56 @@ async def handle_message(message):
         logger.error(f"Message handling error: {e}")
         await bot.reply_to(message, "❌ Error processing your request.")
 
+# Keep references to in-flight update tasks so they are not garbage collected
+_update_tasks: set[asyncio.Task] = set()
+
+async def telegram_webhook(request: web.Request) -> web.Response:
+    """Receive a Telegram update pushed to the webhook"""
+    received_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(received_secret.encode("utf-8", "surrogateescape"), TELEGRAM_WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+    
+    try:
+        update = Update.de_json(orjson.loads(await request.read()))
+    except Exception as e:
+        # Malformed JSON, non-object bodies, missing update_id, bad field types...
+        logger.warning(f"⚠️ Rejected malformed webhook update: {e}")
+        return web.Response(status=400)
+    
+    # Acknowledge immediately; handlers can take seconds (LLM + tool calls)
+    # and Telegram retries updates that are not answered in time
+    task = asyncio.create_task(bot.process_new_updates([update]))
+    _update_tasks.add(task)
+    task.add_done_callback(_update_tasks.discard)
+    return web.Response()
+
+async def run_webhook():
+    """Serve Telegram updates via webhook on the running event loop"""
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, "0.0.0.0", int(TELEGRAM_WEBHOOK_PORT))
+        await site.start()
+        
+        webhook_url = TELEGRAM_WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+        await bot.set_webhook(url=webhook_url, secret_token=TELEGRAM_WEBHOOK_SECRET)
+        logger.info(f"🪝 Webhook listening on port {TELEGRAM_WEBHOOK_PORT}, registered at {webhook_url}")
+        
+        # Serve until cancelled
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     """Main function"""
+    global llm_client
+    
     if not validate_config():
         print("❌ Error: Configuration validation failed")
+        log_listener.stop()
         return
     
     logger.info("🚀 Starting n8n MCP Telegram Client")
@@ -677,18 +919,54 @@ async def main():
     logger.info(f"🤖 AI model: {OPWEBUI_MODEL}")
 
     try:
-        await bot.polling(none_stop=True)
+        limits = httpx.Limits(max_connections=50, max_keepalive_connections=20)
+        llm_client = httpx.AsyncClient(http2=True, limits=limits, timeout=60.0)
+        
+        if TELEGRAM_WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # Polling fails while a webhook is registered
+            try:
+                await bot.remove_webhook()
+            except Exception as e:
+                logger.warning(f"⚠️ Could not remove Telegram webhook: {e}")
+            await bot.polling(none_stop=True)
     except KeyboardInterrupt:
         logger.info("🛑 Received interrupt signal")
     except Exception as e:
         logger.error(f"Runtime error: {e}")
     finally:
         logger.info("🛑 Shutting down")
-        await bot.close_session()
+        # Stop in-flight webhook updates before the clients they use are closed
+        if _update_tasks:
+            pending_tasks = list(_update_tasks)
+            for task in pending_tasks:
+                task.cancel()
+            results = await asyncio.gather(*pending_tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"Update processing error during shutdown: {result}")
+            logger.info(f"🛑 Cancelled {len(pending_tasks)} in-flight updates")
+        await mcp_client.aclose()
+        if llm_client is not None:
+            await llm_client.aclose()
+        try:
+            # Raises if no Telegram request was ever made (e.g. the webhook port failed to bind)
+            await bot.close_session()
+        except Exception as e:
+            logger.warning(f"⚠️ Could not close Telegram session: {e}")
+        log_listener.stop()
 
 if __name__ == "__main__":
     print("🚀 Starting application...")
     try:
+        # Use uvloop when available (not supported on Windows)
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
+        
         asyncio.run(main())
     except Exception as e:
         print(f"❌ Fatal error: {e}")